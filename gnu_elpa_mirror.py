@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
 import json
@@ -10,26 +11,26 @@ import re
 import shutil
 import subprocess
 import sys
-import tempfile
+import threading
+import time
 from typing import Any
 
 import dotenv
 import github
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 os.chdir(os.path.dirname(__file__))
 dotenv.load_dotenv()
 
 
-def remove_prefix(prefix, string):
-    if string.startswith(prefix):
-        return string[len(prefix) :]
-    else:
-        return string
+LOG_LOCK = threading.Lock()
 
 
 def log(message):
-    print(message, file=sys.stderr)
+    with LOG_LOCK:
+        print(message, file=sys.stderr)
 
 
 def die(message):
@@ -45,6 +46,195 @@ except KeyError:
 
 WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
 
+# Number of connections git may use in parallel when fetching
+# submodules or multiple remotes.
+GIT_JOBS = int(os.environ.get("GEM_GIT_JOBS", "8"))
+
+# Reuse connections across requests, since we download hundreds of
+# tarballs from the same host.
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=5, backoff_factor=1, status_forcelist=[500, 502, 503, 504]
+        ),
+    ),
+)
+
+
+def with_retries(fn, *, exceptions, delays=(10, 10, 60, 300)):
+    # Wrap only the network operation itself, so a transient failure
+    # doesn't make us redo any local work. Don't log the exception,
+    # since it may contain a URL with credentials in it.
+    for delay in (*delays, None):
+        try:
+            return fn()
+        except exceptions as e:
+            if delay is None:
+                raise
+            # Client errors won't go away by themselves, whether they
+            # come through PyGithub or from our own requests.
+            if isinstance(e, github.GithubException) and e.status < 500:
+                raise
+            if (
+                isinstance(e, requests.HTTPError)
+                and e.response is not None
+                and e.response.status_code < 500
+            ):
+                raise
+            log(f"(got {type(e).__name__}, retrying in {delay} seconds)")
+            time.sleep(delay)
+
+
+# PyGithub's requester reuses one connection for every call, which
+# isn't safe to share between threads, so make one call at a time.
+# This also keeps us clear of GitHub's secondary rate limits on
+# concurrent writes.
+GITHUB_LOCK = threading.Lock()
+
+
+def create_repo(org, name, **kwargs):
+    with GITHUB_LOCK:
+        return org.create_repo(
+            name,
+            has_issues=False,
+            has_wiki=False,
+            has_projects=False,
+            auto_init=False,
+            **kwargs,
+        )
+
+
+def edit_repo(repo_obj, **kwargs):
+    # PyGithub sends the current name along with every edit. Take it
+    # from the URL so that a lazy repository object doesn't have to be
+    # fetched first.
+    kwargs.setdefault("name", repo_obj.url.rsplit("/", 1)[-1])
+
+    def edit():
+        with GITHUB_LOCK:
+            repo_obj.edit(**kwargs)
+
+    with_retries(
+        edit,
+        exceptions=(github.GithubException, requests.RequestException),
+    )
+
+
+def graphql(query, variables):
+    def request():
+        resp = SESSION.post(
+            "https://api.github.com/graphql",
+            headers={"Authorization": f"bearer {ACCESS_TOKEN}"},
+            json={"query": query, "variables": variables},
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    result = with_retries(request, exceptions=requests.RequestException)
+    if result.get("errors"):
+        die("GraphQL request failed: " + json.dumps(result["errors"]))
+    return result["data"]
+
+
+def update_descriptions(descriptions: dict[str, str]):
+    # Editing repositories one at a time over REST costs a round trip
+    # each, so look up the node IDs and then update the descriptions
+    # for a batch of repositories per GraphQL request instead.
+    names = sorted(descriptions)
+    for start in range(0, len(names), 50):
+        batch = list(enumerate(names[start : start + 50]))
+        query = "query({}) {{ {} }}".format(
+            ", ".join(f"$name{i}: String!" for i, _ in batch),
+            " ".join(
+                f'repo{i}: repository(owner: "emacs-straight", name: $name{i}) '
+                "{ id }"
+                for i, _ in batch
+            ),
+        )
+        ids = graphql(query, {f"name{i}": name for i, name in batch})
+        mutation = "mutation({}) {{ {} }}".format(
+            ", ".join(f"$id{i}: ID!, $description{i}: String!" for i, _ in batch),
+            " ".join(
+                f"repo{i}: updateRepository(input: "
+                f"{{repositoryId: $id{i}, description: $description{i}}}) "
+                "{ clientMutationId }"
+                for i, _ in batch
+            ),
+        )
+        variables = {}
+        for i, name in batch:
+            variables[f"id{i}"] = ids[f"repo{i}"]["id"]
+            variables[f"description{i}"] = descriptions[name]
+        graphql(mutation, variables)
+
+
+MIRRORED_REFSPECS = [
+    "+refs/heads/*:refs/heads/*",
+    "+refs/tags/*:refs/tags/*",
+    "+refs/change/*:refs/change/*",
+]
+
+
+def parse_refs(lines, *, sep):
+    refs = {}
+    for line in lines:
+        sha, _, ref = line.partition(sep)
+        if ref.startswith(("refs/heads/", "refs/tags/", "refs/change/")):
+            # Skip peeled tags, git show-ref doesn't list them.
+            if not ref.endswith("^{}"):
+                refs[ref] = sha
+    return refs
+
+
+def get_local_refs(repo_dir):
+    # No check=True because show-ref fails when there are no refs.
+    result = subprocess.run(
+        ["git", "show-ref"],
+        cwd=repo_dir,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    return parse_refs(result.stdout.splitlines(), sep=" ")
+
+
+# The next few functions read refs straight from the repository
+# instead of starting a git process for every lookup.
+
+
+def get_git_dir(repo_dir: Path) -> Path:
+    git_dir = repo_dir / ".git"
+    return git_dir if git_dir.is_dir() else repo_dir
+
+
+def read_head_ref(repo_dir: Path) -> str:
+    # Like git symbolic-ref HEAD.
+    head = (get_git_dir(repo_dir) / "HEAD").read_text().strip()
+    return head.removeprefix("ref: ")
+
+
+def read_head_commit(repo_dir: Path) -> str:
+    # Like git rev-parse HEAD. The ref may be a loose file or be
+    # listed in packed-refs.
+    git_dir = get_git_dir(repo_dir)
+    ref = read_head_ref(repo_dir)
+    if not ref.startswith("refs/"):
+        # Detached HEAD
+        return ref
+    try:
+        return (git_dir / ref).read_text().strip()
+    except FileNotFoundError:
+        pass
+    with open(git_dir / "packed-refs") as f:
+        for line in f:
+            sha, _, name = line.rstrip("\n").partition(" ")
+            if name == ref:
+                return sha
+    die(f"failed to resolve HEAD in {repo_dir}")
+
 
 def clone_git_repo(
     git_url,
@@ -55,6 +245,8 @@ def clone_git_repo(
     exclude_patterns=[],
     additional_refspecs=[],
     recursive=False,
+    partial_filter=None,
+    shallow=False,
 ):
     # Basically reimplement --mirror ourselves because it is the most
     # elegant way to solve https://stackoverflow.com/a/54413257/3538165.
@@ -67,49 +259,90 @@ def clone_git_repo(
             cmd += ["--bare"]
         cmd += [repo_dir]
         subprocess.run(cmd, check=True)
+    fetch_args = [git_url]
+    if partial_filter:
+        # Partial clones need a named promisor remote to lazily fetch
+        # missing objects from, so the URL ends up in the config. Not
+        # something we can do with credentials in the URL.
+        assert not private_url
+        for key, value in (
+            ("core.repositoryformatversion", "1"),
+            ("extensions.partialClone", "origin"),
+            ("remote.origin.url", git_url),
+            ("remote.origin.promisor", "true"),
+            ("remote.origin.partialCloneFilter", partial_filter),
+        ):
+            subprocess.run(["git", "config", key, value], cwd=repo_dir, check=True)
+        fetch_args = [f"--filter={partial_filter}", "origin"]
+    if shallow:
+        # Only for repositories whose history we never look at, and
+        # that we only ever push new commits on top of.
+        fetch_args = ["--depth=1", *fetch_args]
     try:
-        subprocess.run(
+        result = subprocess.run(
             [
                 "git",
-                "fetch",
-                "--prune",
-                "--force",
-                "--update-head-ok",
+                "-c",
+                "protocol.version=2",
+                "ls-remote",
+                "--symref",
                 git_url,
-                "+refs/heads/*:refs/heads/*",
-                "+refs/tags/*:refs/tags/*",
-                "+refs/change/*:refs/change/*",
-                *additional_refspecs,
+                # Git matches these patterns itself rather than sending
+                # them to the server as ref prefixes, but at least it
+                # saves us from wading through refs/pull/* and the like.
+                "HEAD",
+                *(refspec[1:].split(":")[0] for refspec in MIRRORED_REFSPECS),
             ],
             cwd=repo_dir,
-            check=True,
-        )
-    except subprocess.CalledProcessError:
-        if private_url:
-            die("cloning repository failed (details omitted for security)")
-        raise
-    try:
-        result = subprocess.run(
-            ["git", "ls-remote", "--symref", git_url, "HEAD"],
-            cwd=repo_dir,
             stdout=subprocess.PIPE,
+            text=True,
             check=True,
         )
-        output = result.stdout.decode().splitlines()
-        if not output:
-            # Probably a new/empty repository
-            return
-        match = re.fullmatch(
-            r"ref: (refs/heads/.+?)\s+HEAD",
-            output[0],
-        )
-        if not match:
-            die("failed to parse ls-remote output: " + "\n".join(output))
-        remote_head = match.group(1)  # type: ignore
     except subprocess.CalledProcessError:
         if private_url:
-            die("determining remote HEAD failed (details omitted for security)")
+            die("listing remote refs failed (details omitted for security)")
         raise
+    output = result.stdout.splitlines()
+    remote_refs = parse_refs(output, sep="\t")
+    # Most repositories don't change between runs, so don't bother
+    # fetching unless the refs we would update are out of date.
+    if additional_refspecs or remote_refs != get_local_refs(repo_dir):
+        try:
+            subprocess.run(
+                [
+                    "git",
+                    "-c",
+                    "protocol.version=2",
+                    "-c",
+                    f"fetch.parallel={GIT_JOBS}",
+                    "fetch",
+                    "--jobs",
+                    str(GIT_JOBS),
+                    "--prune",
+                    "--force",
+                    "--update-head-ok",
+                    *fetch_args,
+                    *MIRRORED_REFSPECS,
+                    *additional_refspecs,
+                ],
+                cwd=repo_dir,
+                check=True,
+            )
+        except subprocess.CalledProcessError:
+            if private_url:
+                die("cloning repository failed (details omitted for security)")
+            raise
+    head_output = [line for line in output if line.endswith("\tHEAD")]
+    if not head_output:
+        # Probably a new/empty repository
+        return remote_refs, None
+    match = re.fullmatch(
+        r"ref: (refs/heads/.+?)\s+HEAD",
+        head_output[0],
+    )
+    if not match:
+        die("failed to parse ls-remote output: " + "\n".join(head_output))
+    remote_head = match.group(1)  # type: ignore
     if bare:
         subprocess.run(
             ["git", "symbolic-ref", "HEAD", remote_head], cwd=repo_dir, check=True
@@ -135,61 +368,104 @@ def clone_git_repo(
             subprocess.run(
                 [
                     "git",
+                    "-c",
+                    f"submodule.fetchJobs={GIT_JOBS}",
                     "submodule",
                     "update",
                     "--init",
                     "--recursive",
+                    "--jobs",
+                    str(GIT_JOBS),
                     "--checkout",
                     "--force",
                 ],
                 cwd=repo_dir,
                 check=True,
             )
+    return remote_refs, remote_head
 
 
-def push_git_repo(git_url, repo_dir, repo_obj):
+def push_refs(git_url, repo_dir):
     try:
-        subprocess.run(
-            [
-                "git",
-                "push",
-                "--prune",
-                "--force",
-                git_url,
-                "+refs/heads/*:refs/heads/*",
-                "+refs/tags/*:refs/tags/*",
-                "+refs/change/*:refs/change/*",
-            ],
-            cwd=repo_dir,
-            check=True,
+        with_retries(
+            lambda: subprocess.run(
+                [
+                    "git",
+                    "push",
+                    "--prune",
+                    "--force",
+                    git_url,
+                    *MIRRORED_REFSPECS,
+                ],
+                cwd=repo_dir,
+                check=True,
+            ),
+            exceptions=subprocess.CalledProcessError,
         )
     except subprocess.CalledProcessError:
         die("cloning repository failed (details omitted for security)")
-    branch = (
-        subprocess.run(
-            ["git", "symbolic-ref", "HEAD"],
-            stdout=subprocess.PIPE,
-            check=True,
-            cwd=repo_dir,
-        )
-        .stdout.decode()
-        .strip()
-        .removeprefix("refs/heads/")
-    )
-    repo_obj.edit(default_branch=branch)
+
+
+def push_git_repo(git_url, repo_dir, repo_obj, remote=None):
+    # If we know what the remote looked like when we cloned from it,
+    # skip the push when there is nothing new, and only touch the
+    # default branch when it has actually changed.
+    remote_refs, remote_head = remote or (None, None)
+    local_head = read_head_ref(repo_dir)
+    if remote_refs is not None and get_local_refs(repo_dir) == remote_refs:
+        log("(already up to date)")
+    else:
+        push_refs(git_url, repo_dir)
+    if local_head != remote_head:
+        edit_repo(repo_obj, default_branch=local_head.removeprefix("refs/heads/"))
+
+
+def run_parallel(fn, items, jobs):
+    # Per-package work is dominated by network and git latency, so
+    # threads are enough to overlap it. Let everything finish and
+    # report every failure, so that one broken package doesn't hide
+    # problems with the others, then re-raise the first one
+    # (including SystemExit from die) in the calling thread. As in
+    # with_retries, only the exception type is logged.
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [(item, executor.submit(fn, item)) for item in items]
+    errors = []
+    for item, future in futures:
+        if future.exception() is not None:
+            # Name functions (the mirrors) rather than printing their
+            # repr.
+            name = getattr(item, "__name__", item)
+            log(f"(failed on {name}: {type(future.exception()).__name__})")
+            errors.append(future.exception())
+    if errors:
+        raise errors[0]
 
 
 def delete_contents(path):
-    for entry in sorted(path.iterdir()):
-        if entry.name == ".git":
-            continue
-        if entry.is_dir() and not entry.is_symlink():
-            shutil.rmtree(entry)
-        else:
-            try:
-                entry.unlink()
-            except FileNotFoundError:
-                pass
+    if (path / ".git").exists():
+        # Let git remove everything in native code rather than walking
+        # the tree from Python. stage_and_commit repopulates the index
+        # afterwards.
+        subprocess.run(
+            ["git", "rm", "-r", "-f", "-q", "--ignore-unmatch", "--", "."],
+            cwd=path,
+            check=True,
+        )
+        subprocess.run(["git", "clean", "-ffdxq"], cwd=path, check=True)
+        return
+    # Order doesn't matter here, and DirEntry caches the file type
+    # from the directory listing, so this doesn't stat every entry.
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name == ".git":
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
 
 
 def stage_and_commit(repo_dir, message):
@@ -199,32 +475,53 @@ def stage_and_commit(repo_dir, message):
     #
     # [1]: https://github.com/raxod502/straight.el/issues/299
     subprocess.run(["git", "add", "--all", "--force"], cwd=repo_dir, check=True)
-    anything_staged = (
-        subprocess.run(["git", "diff", "--cached", "--quiet"], cwd=repo_dir).returncode
-        != 0
+    commit_index(repo_dir, message)
+
+
+def commit_index(repo_dir, message):
+    # Rather than asking git diff --cached whether anything is staged
+    # first, just try to commit. git commit exits with status 1 when
+    # there is nothing to commit, but also for some real failures,
+    # so check what it said too (in English, hence LC_ALL). Index-only
+    # commits leave unstaged deletions behind, which changes the
+    # message.
+    result = subprocess.run(
+        [
+            "git",
+            "-c",
+            "user.name=GNU ELPA Mirror Bot",
+            "-c",
+            "user.email=contact+gnu-elpa-mirror@radian.codes",
+            "commit",
+            "--untracked-files=no",
+            "-m",
+            message,
+        ],
+        cwd=repo_dir,
+        env={**os.environ, "LC_ALL": "C"},
+        stdout=subprocess.PIPE,
+        text=True,
     )
-    if anything_staged:
-        subprocess.run(
-            [
-                "git",
-                "-c",
-                "user.name=GNU ELPA Mirror Bot",
-                "-c",
-                "user.email=contact+gnu-elpa-mirror@radian.codes",
-                "commit",
-                "-m",
-                message,
-            ],
-            cwd=repo_dir,
-            check=True,
-        )
-    else:
+    if result.returncode == 1 and (
+        "nothing to commit" in result.stdout
+        or "no changes added to commit" in result.stdout
+    ):
         log("(no changes)")
+        return
+    result.check_returncode()
+    log(result.stdout.rstrip())
 
 
 THIS_DIR = Path(".").resolve()
 REPOS_SUBDIR = THIS_DIR / "repos"
 GNU_ELPA_SUBDIR = THIS_DIR / "gnu-elpa"
+# Package versions as of the last successful push, so that unchanged
+# packages can be skipped on the next run.
+MANIFEST_FILE = REPOS_SUBDIR / ".manifest.json"
+# ETags and repository names for each page of the emacs-straight
+# repository listing, so that unchanged pages can be revalidated
+# without counting against the rate limit.
+REPO_LIST_FILE = REPOS_SUBDIR / ".repo-list.json"
 
 
 @dataclass
@@ -241,58 +538,94 @@ class ELPAPackage:
         return f"https://elpa.gnu.org/devel/{self.tarball_name}"
 
 
-def make_commit_message(
-    message: str, timestamp: datetime, pkg: ELPAPackage | None = None
-):
-    message += f"\n\nTimestamp: {timestamp.strftime('%Y-%m-%d %H:%M:%S')}"
+def make_commit_message(message: str, timestamp: str, pkg: ELPAPackage | None = None):
+    message += f"\n\nTimestamp: {timestamp}"
     if pkg:
         message += f"\nSourced from {pkg.name} version {pkg.version} on GNU ELPA Devel"
         message += f"\n(see https://elpa.gnu.org/devel/{pkg.name}.html)"
     return message
 
 
-def read_elpa_index(path: Path) -> Any:
-    # WARNING: path basename can't have special chars
-    path = path.resolve()
-    return json.loads(
-        subprocess.run(
-            [
-                "emacs",
-                "-Q",
-                "--batch",
-                "-l",
-                "package",
-                "-l",
-                "json",
-                "--eval",
-                f"""\
-(with-temp-buffer
-  (insert-file-contents "{path.name}")
-  (princ
-   (json-encode
-    (mapcar
-     (lambda (spec)
-       (cons
-        (car spec)
-        (package-version-join (aref (cdr spec) 0))))
-    (seq-filter #'listp (read (current-buffer)))))))
-""",
-            ],
-            stdout=subprocess.PIPE,
-            cwd=path.parent,
-        ).stdout.decode()
-    )
+SEXP_TOKEN_RE = re.compile(
+    r"""
+    \s+ | ;[^\n]*
+    | (?P<open>[(\[]) | (?P<close>[)\]])
+    | "(?P<string>(?:[^"\\]|\\.)*)"
+    | (?P<atom>(?:[^\s()\[\]";\\]|\\.)+)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+
+def read_sexp(text: str) -> Any:
+    # Just enough of an Emacs Lisp reader for archive-contents, so we
+    # don't have to start Emacs to parse it. Lists become Python
+    # lists and vectors become tuples. Dotted pairs are flattened, so
+    # (a . [b]) reads the same as (a [b]), which is fine for our
+    # purposes.
+    stack: list[list] = [[]]
+    dotted = False
+    for match in SEXP_TOKEN_RE.finditer(text):
+        if match.group("open"):
+            stack.append([])
+            continue
+        if match.group("close"):
+            items = stack.pop()
+            value = tuple(items) if match.group("close") == "]" else items
+        elif match.group("string") is not None:
+            value = re.sub(r"\\(.)", r"\1", match.group("string"))
+        elif match.group("atom") == ".":
+            dotted = True
+            continue
+        elif match.group("atom"):
+            atom = re.sub(r"\\(.)", r"\1", match.group("atom"))
+            try:
+                value = int(atom)
+            except ValueError:
+                value = atom
+        else:
+            continue
+        if dotted and isinstance(value, list):
+            stack[-1].extend(value)
+        else:
+            stack[-1].append(value)
+        dotted = False
+    if len(stack) != 1 or len(stack[0]) != 1:
+        raise ValueError("malformed s-expression")
+    return stack[0][0]
+
+
+def join_version(version: list[int]) -> str:
+    # Port of package-version-join from package.el.
+    parts = [str(version[0]), "."]
+    for num in version[1:]:
+        if num >= 0:
+            parts += [str(num), "."]
+        else:
+            if parts[-1] == ".":
+                parts.pop()
+            parts.append({-1: "pre", -2: "beta", -3: "alpha", -4: "snapshot"}[num])
+    if parts[-1] == ".":
+        parts.pop()
+    return "".join(parts)
+
+
+def read_elpa_index(text: str) -> dict[str, str]:
+    # The archive-contents format is (VERSION (NAME . [VERSION-LIST
+    # ...]) ...), skip the leading format version.
+    return {
+        spec[0]: join_version(spec[1][0])
+        for spec in read_sexp(text)
+        if isinstance(spec, list)
+    }
 
 
 def get_elpa_contents(archive_url: str) -> list[ELPAPackage]:
     if not archive_url.endswith("/"):
         archive_url += "/"
-    resp = requests.get(archive_url + "archive-contents")
+    resp = SESSION.get(archive_url + "archive-contents")
     resp.raise_for_status()
-    with tempfile.NamedTemporaryFile("w") as f:
-        f.write(resp.text)
-        f.flush()
-        data = read_elpa_index(Path(f.name))
+    data = read_elpa_index(resp.content.decode())
     return [
         ELPAPackage(name, version)
         for name, version in data.items()
@@ -304,75 +637,137 @@ def get_elpa_contents(archive_url: str) -> list[ELPAPackage]:
     ]
 
 
-def mirror_gnu_elpa(args, api, existing_repos):
-    package_filter = (
-        lambda name: name == args.mirror_only_one or not args.mirror_only_one
-    )
+def read_manifest() -> dict[str, str]:
+    try:
+        with open(MANIFEST_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_manifest(manifest: dict[str, str]):
+    tmp_file = MANIFEST_FILE.with_name(MANIFEST_FILE.name + ".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    tmp_file.replace(MANIFEST_FILE)
+
+
+def get_repo_names(jobs: int) -> list[str]:
+    def page_url(page):
+        return f"https://api.github.com/users/emacs-straight/repos?per_page=100&page={page}"
+
+    try:
+        with open(REPO_LIST_FILE) as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        cache = {}
+
+    def get_page(page):
+        headers = {"Authorization": f"token {ACCESS_TOKEN}"}
+        if page_url(page) in cache:
+            headers["If-None-Match"] = cache[page_url(page)]["etag"]
+        resp = SESSION.get(page_url(page), headers=headers)
+        if resp.status_code == 304:
+            return
+        resp.raise_for_status()
+        cache[page_url(page)] = {
+            "etag": resp.headers["ETag"],
+            "names": [repo["name"] for repo in resp.json()],
+        }
+
+    # Revalidate the pages we saw last time in parallel. The listing
+    # is sorted by name, so a new repository can push names onto a
+    # page we have never requested even when the earlier pages are
+    # unchanged. Keep going until we reach a page that isn't full.
+    num_cached = max(len(cache), 1)
+    run_parallel(get_page, range(1, num_cached + 1), jobs)
+    last_page = 1
+    while len(cache[page_url(last_page)]["names"]) == 100:
+        last_page += 1
+        if last_page > num_cached:
+            get_page(last_page)
+    pages = range(1, last_page + 1)
+    REPOS_SUBDIR.mkdir(exist_ok=True)
+    tmp_file = REPO_LIST_FILE.with_name(REPO_LIST_FILE.name + ".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(
+            {page_url(page): cache[page_url(page)] for page in pages}, f, indent=2
+        )
+    tmp_file.replace(REPO_LIST_FILE)
+    return [name for page in pages for name in cache[page_url(page)]["names"]]
+
+
+def extract_tarball(pkg: ELPAPackage, repo_dir: Path, *, cached: bool):
+    tar_cmd = ["tar", "-C", str(repo_dir), "-xf", "-", "--strip-components=1"]
+    tarball = GNU_ELPA_SUBDIR / pkg.tarball_name
+    if cached:
+        with open(tarball, "rb") as f:
+            subprocess.run(tar_cmd, stdin=f, check=True)
+        return
+    log(f"----> download {pkg.tarball_url}")
+    # Feed the download straight into tar instead of reading the
+    # tarball back from disk afterwards. We still keep a copy so that
+    # reruns don't have to download it again, but only rename it into
+    # place once it is complete.
+    partial = tarball.with_name(tarball.name + ".part")
+    with SESSION.get(pkg.tarball_url, stream=True) as resp:
+        resp.raise_for_status()
+        # Read straight from the urllib3 response in large blocks,
+        # rather than going through iter_content in small chunks.
+        resp.raw.decode_content = True
+        with subprocess.Popen(tar_cmd, stdin=subprocess.PIPE) as tar, open(
+            partial, "wb"
+        ) as f:
+            while chunk := resp.raw.read(1024 * 1024):
+                f.write(chunk)
+                tar.stdin.write(chunk)  # type: ignore
+    if tar.returncode != 0:
+        raise subprocess.CalledProcessError(tar.returncode, tar_cmd)
+    partial.rename(tarball)
+
+
+def mirror_gnu_elpa(args, org, existing_repos):
     log("--> check timestamp and commit hashes")
-    timestamp = datetime.now()
-    commit_data = {
-        "timestamp": timestamp,
-    }
+    # Format these once rather than for every package.
+    now = datetime.now()
+    timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+    brief_timestamp = now.strftime("%Y-%m-%d")
     log("--> check GNU ELPA archive index")
     elpa_packages = get_elpa_contents("https://elpa.gnu.org/devel/")
-    log("--> download GNU ELPA tarballs")
-    GNU_ELPA_SUBDIR.mkdir(exist_ok=True)
-    existing_tarballs = set(os.listdir(GNU_ELPA_SUBDIR))
-    for pkg in elpa_packages:
-        if not package_filter(pkg.name):
-            continue
-        if pkg.tarball_name in existing_tarballs:
-            continue
-        log(f"----> download {pkg.tarball_url}")
-        resp = requests.get(pkg.tarball_url, stream=True)
-        resp.raise_for_status()
-        with open(GNU_ELPA_SUBDIR / pkg.tarball_name, "wb") as f:
-            for chunk in resp.iter_content(10 * 1024):
-                f.write(chunk)
-    log("--> clone/update mirror repositories")
-    org = api.get_organization("emacs-straight")
-    REPOS_SUBDIR.mkdir(exist_ok=True)
-    for pkg in elpa_packages:
-        if not package_filter(pkg.name):
-            continue
-        github_package = pkg.name.replace("+", "-plus")
-        git_url = "https://raxod502:{}@github.com/emacs-straight/{}.git".format(
-            ACCESS_TOKEN, github_package
+    selected_packages = [
+        pkg
+        for pkg in elpa_packages
+        if pkg.name == args.mirror_only_one or not args.mirror_only_one
+    ]
+
+    def get_git_url(pkg):
+        return "https://raxod502:{}@github.com/emacs-straight/{}.git".format(
+            ACCESS_TOKEN, pkg.name.replace("+", "-plus")
         )
+
+    def clone_pkg(pkg):
+        github_package = pkg.name.replace("+", "-plus")
         repo_dir = REPOS_SUBDIR / pkg.name
         if github_package not in existing_repos:
             log("----> create mirror repository {}".format(pkg.name))
-            org.create_repo(
+            existing_repos[github_package] = create_repo(
+                org,
                 github_package,
                 description=("Mirror of the {} package from GNU ELPA".format(pkg.name)),
                 homepage=("https://elpa.gnu.org/packages/{}.html".format(pkg.name)),
-                has_issues=False,
-                has_wiki=False,
-                has_projects=False,
-                auto_init=False,
             )
         if args.skip_mirror_pulls and repo_dir.is_dir():
-            continue
+            return None
         log("----> clone/update mirror repository {}".format(pkg.name))
-        clone_git_repo(git_url, repo_dir, private_url=True)
-    log("--> update mirrored packages")
-    for pkg in elpa_packages:
-        if not package_filter(pkg.name):
-            continue
-        log("----> update package {}".format(pkg.name))
+        return clone_git_repo(
+            get_git_url(pkg), repo_dir, private_url=True, shallow=True
+        )
+
+    def update_pkg(pkg):
         repo_dir = REPOS_SUBDIR / pkg.name
+        log("----> update package {}".format(pkg.name))
         delete_contents(repo_dir)
-        subprocess.run(
-            [
-                "tar",
-                "-C",
-                str(repo_dir),
-                "-xf",
-                str(GNU_ELPA_SUBDIR / pkg.tarball_name),
-                "--strip-components=1",
-            ],
-            check=True,
-        )
+        extract_tarball(pkg, repo_dir, cached=pkg.tarball_name in existing_tarballs)
         # Remove files that may make GitHub interpret this repo
         # specially, as it should just be a static fork with the
         # packaging files.
@@ -390,26 +785,68 @@ def mirror_gnu_elpa(args, api, existing_repos):
         stage_and_commit(
             repo_dir, make_commit_message("Update " + pkg.name, timestamp, pkg)
         )
+
+    def push_pkg(pkg, remote):
+        log("----> push changes to package {}".format(pkg.name))
+        repo_dir = REPOS_SUBDIR / pkg.name
+        repo_obj = existing_repos[pkg.name.replace("+", "-plus")]
+        push_git_repo(get_git_url(pkg), repo_dir, repo_obj, remote)
+        pushed_versions[pkg.name] = pkg.version
+
+    def mirror_pkg(pkg):
+        remote = clone_pkg(pkg)
+        update_pkg(pkg)
+        if not args.skip_mirror_pushes:
+            push_pkg(pkg, remote)
+
+    # GNU ELPA Devel versions include the upstream commit date, so an
+    # unchanged version means unchanged contents, and the mirror
+    # already has them. Leave those packages alone entirely, unless
+    # we were asked to mirror one package in particular.
+    manifest = read_manifest()
+    changed_packages = [
+        pkg
+        for pkg in selected_packages
+        if args.mirror_only_one
+        or manifest.get(pkg.name) != pkg.version
+        or pkg.name.replace("+", "-plus") not in existing_repos
+    ]
+    log(
+        "--> {} of {} packages changed".format(
+            len(changed_packages), len(selected_packages)
+        )
+    )
+    REPOS_SUBDIR.mkdir(exist_ok=True)
+    GNU_ELPA_SUBDIR.mkdir(exist_ok=True)
+    with os.scandir(GNU_ELPA_SUBDIR) as entries:
+        existing_tarballs = {entry.name for entry in entries}
+    log("--> clone, update and push mirrored packages")
+    pushed_versions = {}
+    try:
+        # Take each package all the way through rather than finishing
+        # one stage for every package before starting the next, so
+        # that slow clones, extractions and pushes overlap.
+        run_parallel(
+            mirror_pkg,
+            changed_packages,
+            args.jobs,
+        )
+    finally:
+        # Record whatever made it to GitHub, even if some pushes
+        # failed.
+        write_manifest({**manifest, **pushed_versions})
     if not args.skip_mirror_pushes:
-        log("--> push changes to mirrored packages")
-        for pkg in elpa_packages:
-            if not package_filter(pkg.name):
-                continue
-            log("----> push changes to package {}".format(pkg.name))
-            repo_dir = REPOS_SUBDIR / pkg.name
-            github_package = pkg.name.replace("+", "-plus")
-            git_url = "https://raxod502:{}@github.com/emacs-straight/{}.git".format(
-                ACCESS_TOKEN, github_package
-            )
-            repo_obj = org.get_repo(github_package)
-            push_git_repo(git_url, repo_dir, repo_obj)
-            log("----> update repo description for package {}".format(pkg.name))
-            repo_obj.edit(
-                description="Mirror of the {} package from GNU ELPA, current as of {}".format(
-                    pkg.name,
-                    timestamp.strftime("%Y-%m-%d"),
-                )
+        # Unchanged packages are still current, so their descriptions
+        # should say so too. Batching makes refreshing all of them
+        # cheap.
+        log("--> update repo descriptions for mirrored packages")
+        descriptions = {}
+        for pkg in selected_packages:
+            description = "Mirror of the {} package from GNU ELPA, current as of {}"
+            descriptions[pkg.name.replace("+", "-plus")] = description.format(
+                pkg.name, brief_timestamp
             )
+        update_descriptions(descriptions)
     if not args.skip_mirror_index:
         git_url = "https://raxod502:{}@github.com/emacs-straight/{}.git".format(
             ACCESS_TOKEN, "gnu-elpa-mirror"
@@ -417,32 +854,72 @@ def mirror_gnu_elpa(args, api, existing_repos):
         repo_dir = REPOS_SUBDIR / "gnu-elpa-mirror"
         if "gnu-elpa-mirror" not in existing_repos:
             log("--> create mirror list repository")
-            org.create_repo(
+            existing_repos["gnu-elpa-mirror"] = create_repo(
+                org,
                 "gnu-elpa-mirror",
                 description="List packages mirrored from GNU ELPA",
                 homepage="https://elpa.gnu.org/packages/",
-                has_issues=False,
-                has_wiki=False,
-                has_projects=False,
-                auto_init=False,
             )
         log("--> clone/update mirror list repository")
-        clone_git_repo(git_url, repo_dir, private_url=True)
+        remote = clone_git_repo(git_url, repo_dir, private_url=True, shallow=True)
         log("--> update mirror list repository")
-        delete_contents(repo_dir)
-        for pkg in elpa_packages:
-            with open(repo_dir / pkg.name, "w"):
-                pass
-        stage_and_commit(repo_dir, make_commit_message("Update mirror list", timestamp))
+        # Every file is empty and only the names matter, so build the
+        # index directly instead of writing the files and scanning the
+        # worktree for them. The checkout catches up on the next run.
+        empty_blob = subprocess.run(
+            ["git", "hash-object", "-w", "--stdin"],
+            cwd=repo_dir,
+            input="",
+            stdout=subprocess.PIPE,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        subprocess.run(["git", "read-tree", "--empty"], cwd=repo_dir, check=True)
+        subprocess.run(
+            ["git", "update-index", "-z", "--index-info"],
+            cwd=repo_dir,
+            input="".join(
+                f"100644 {empty_blob}\t{pkg.name}\0" for pkg in elpa_packages
+            ),
+            text=True,
+            check=True,
+        )
+        commit_index(repo_dir, make_commit_message("Update mirror list", timestamp))
         log("--> push changes to mirror list repository")
-        repo = org.get_repo("gnu-elpa-mirror")
-        push_git_repo(git_url, repo_dir, repo_obj=repo)
+        repo = existing_repos["gnu-elpa-mirror"]
+        push_git_repo(git_url, repo_dir, repo, remote)
         log("--> update repo description for mirror list repository")
-        repo.edit(description="List packages mirrored from GNU ELPA")
+        edit_repo(repo, description="List packages mirrored from GNU ELPA")
 
 
-def mirror_emacsmirror(_, api, existing_repos):
-    org = api.get_organization("emacs-straight")
+SUBMODULE_URL_RE = re.compile(
+    "|".join(
+        (
+            r"https://git.savannah.gnu.org/git/emacs/elpa(?:\.git)?",
+            r"https://git.savannah.gnu.org/git/emacs/nongnu(?:\.git)?",
+            r"https://code.orgmode.org/bzg/org-mode(?:\.git)?",
+            r"git@github.com:(?P<org1>[^/]+)/(?P<repo1>.+?)(?:\.git)?",
+            r"https://github.com/(?P<org2>[^/]+)/(?P<repo2>.+?)(?:\.git)?",
+        )
+    )
+)
+
+
+def parse_submodule_url(url: str) -> tuple[str | None, str | None]:
+    # Almost all submodules are on GitHub, so handle those with plain
+    # string operations and only fall back to the regex for the rest.
+    for prefix in ("git@github.com:", "https://github.com/"):
+        if url.startswith(prefix):
+            orgname, _, name = url.removeprefix(prefix).partition("/")
+            name = name.removesuffix(".git")
+            if orgname and name:
+                return orgname, name
+    m = SUBMODULE_URL_RE.fullmatch(url)
+    assert m, url
+    return m.group("org1") or m.group("org2"), m.group("repo1") or m.group("repo2")
+
+
+def mirror_emacsmirror(_, org, existing_repos):
     epkgs_dir = REPOS_SUBDIR / "epkgs"
     epkgs_git_url = "https://github.com/emacsmirror/epkgs.git"
     epkgs_mirror_dir = REPOS_SUBDIR / "emacsmirror-mirror"
@@ -452,83 +929,85 @@ def mirror_emacsmirror(_, api, existing_repos):
         )
     )
     log("--> clone/update Emacsmirror")
-    clone_git_repo(epkgs_git_url, epkgs_dir, private_url=False)
+    # We only need .gitmodules and the HEAD commit from epkgs, so
+    # don't download the rest of its (large) contents.
+    clone_git_repo(
+        epkgs_git_url,
+        epkgs_dir,
+        private_url=False,
+        bare=True,
+        partial_filter="blob:none",
+        shallow=True,
+    )
     if "emacsmirror-mirror" not in existing_repos:
         log("--> create Emacsmirror mirror repository")
-        org.create_repo(
+        existing_repos["emacsmirror-mirror"] = create_repo(
+            org,
             "emacsmirror-mirror",
             description="Light-weight mirror of the Emacsmirror index",
             homepage="https://github.com/emacsmirror/epkgs",
-            has_issues=False,
-            has_wiki=False,
-            has_projects=False,
-            auto_init=False,
         )
     log("--> clone/update Emacsmirror mirror repository")
-    clone_git_repo(
+    remote = clone_git_repo(
         epkgs_mirror_git_url,
         epkgs_mirror_dir,
         private_url=True,
+        shallow=True,
     )
     log("--> update Emacsmirror mirror")
     delete_contents(epkgs_mirror_dir)
     attic_file = epkgs_mirror_dir / "attic"
     mirror_file = epkgs_mirror_dir / "mirror"
-    num_attic = 0
-    num_mirror = 0
-    with open(attic_file, "w") as attic, open(mirror_file, "w") as mirror:
-        with open(epkgs_dir / ".gitmodules") as gitmodules:
-            for line in gitmodules:
-                m = re.fullmatch(
-                    "|".join(
-                        regex + r"\n"
-                        for regex in (
-                            r'\[submodule "[^"]+"\]',
-                            r"\tpath = .+",
-                            r"\turl = https://git.savannah.gnu.org/git/emacs/elpa(?:\.git)?",
-                            r"\turl = https://git.savannah.gnu.org/git/emacs/nongnu(?:\.git)?",
-                            r"\turl = https://code.orgmode.org/bzg/org-mode(?:\.git)?",
-                            r"\turl = git@github.com:(?P<org1>[^/]+)/(?P<repo1>.+?)(?:\.git)?",
-                            r"\turl = https://github.com/(?P<org2>[^/]+)/(?P<repo2>.+?)(?:\.git)?",
-                            r"\tbranch = .+",
-                        )
-                    ),
-                    line,
-                )
-                assert m, line
-                orgname = m.group("org1") or m.group("org2")
-                name = m.group("repo1") or m.group("repo2")
-                if name == "sql-ident":
-                    # Jonas made a typo and included a spurious
-                    # submodule called sql-ident in addition to the
-                    # real sql-indent one. Filter it out.
-                    continue
-                if orgname == "melpa" and name == "melpa":
-                    continue
-                elif orgname == "emacsmirror" and name == "emacswiki.org":
-                    continue
-                elif orgname == "emacsattic":
-                    attic.write(name + "\n")
-                    num_attic += 1
-                elif orgname == "emacsmirror":
-                    mirror.write(name + "\n")
-                    num_mirror += 1
-                elif orgname is None:
-                    continue
-                else:
-                    assert False, line
-    assert num_attic >= 500 and num_mirror >= 1000
+    attic_names = []
+    mirror_names = []
+    # Let git parse .gitmodules for us. With -z each entry is the key
+    # and value separated by a newline, terminated by a NUL byte.
+    submodule_urls = subprocess.run(
+        [
+            "git",
+            "config",
+            "--blob",
+            "HEAD:.gitmodules",
+            "-z",
+            "--get-regexp",
+            r"^submodule\..*\.url$",
+        ],
+        cwd=epkgs_dir,
+        stdout=subprocess.PIPE,
+        text=True,
+        check=True,
+    ).stdout
+    for entry in submodule_urls.split("\0"):
+        if not entry:
+            continue
+        _, url = entry.split("\n", 1)
+        orgname, name = parse_submodule_url(url)
+        if name == "sql-ident":
+            # Jonas made a typo and included a spurious
+            # submodule called sql-ident in addition to the
+            # real sql-indent one. Filter it out.
+            continue
+        if orgname == "melpa" and name == "melpa":
+            continue
+        elif orgname == "emacsmirror" and name == "emacswiki.org":
+            continue
+        elif orgname == "emacsattic":
+            attic_names.append(name)
+        elif orgname == "emacsmirror":
+            mirror_names.append(name)
+        elif orgname is None:
+            continue
+        else:
+            assert False, url
+    # Sort so the files don't churn when .gitmodules is reordered, and
+    # write each of them in one go.
+    attic_names.sort()
+    mirror_names.sort()
+    attic_file.write_text("".join(name + "\n" for name in attic_names))
+    mirror_file.write_text("".join(name + "\n" for name in mirror_names))
+    assert len(attic_names) >= 500 and len(mirror_names) >= 1000
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    epkgs_commit = (
-        subprocess.run(
-            ["git", "rev-parse", "HEAD"],
-            cwd=epkgs_dir,
-            stdout=subprocess.PIPE,
-            check=True,
-        )
-        .stdout.decode()
-        .strip()
-    )
+    epkgs_commit = read_head_commit(epkgs_dir)
     stage_and_commit(
         epkgs_mirror_dir,
         "Update Emacsmirror mirror\n\nTimestamp: {}\nEmacsmirror commit: {}".format(
@@ -536,15 +1015,14 @@ def mirror_emacsmirror(_, api, existing_repos):
         ),
     )
     log("--> push changes to Emacsmirror mirror repository")
-    repo = org.get_repo("emacsmirror-mirror")
-    push_git_repo(epkgs_mirror_git_url, epkgs_mirror_dir, repo_obj=repo)
+    repo = existing_repos["emacsmirror-mirror"]
+    push_git_repo(epkgs_mirror_git_url, epkgs_mirror_dir, repo, remote)
     log("--> update repo description for Emacsmirror mirror repository")
-    repo.edit(description="Light-weight mirror of the Emacsmirror index")
+    edit_repo(repo, description="Light-weight mirror of the Emacsmirror index")
 
 
-def mirror_orgmode(_, api, existing_repos):
+def mirror_orgmode(_, org, existing_repos):
     brief_timestamp = datetime.now().strftime("%Y-%m-%d")
-    org = api.get_organization("emacs-straight")
     orgmode_dir = REPOS_SUBDIR / "org-mode"
     orgmode_git_url = "https://git.savannah.gnu.org/git/emacs/org-mode.git"
     orgmode_mirror_git_url = (
@@ -561,23 +1039,21 @@ def mirror_orgmode(_, api, existing_repos):
     )
     if "org-mode" not in existing_repos:
         log("--> create org-mode repository")
-        org.create_repo(
+        existing_repos["org-mode"] = create_repo(
+            org,
             "org-mode",
             description="Mirror of org-mode from Savannah",
             homepage="https://git.savannah.gnu.org/git/emacs/org-mode.git",
-            has_issues=False,
-            has_wiki=False,
-            has_projects=False,
-            auto_init=False,
         )
-    repo = org.get_repo("org-mode")
+    repo = existing_repos["org-mode"]
     log("--> push org-mode repository")
     push_git_repo(orgmode_mirror_git_url, orgmode_dir, repo_obj=repo)
     log("--> update repo description for Org")
-    repo.edit(
+    edit_repo(
+        repo,
         description="Mirror of org-mode from Savannah, current as of {}".format(
             brief_timestamp,
-        )
+        ),
     )
 
 
@@ -590,21 +1066,34 @@ def mirror():
     parser.add_argument("--skip-mirror-pushes", action="store_true")
     parser.add_argument("--skip-orgmode", action="store_true")
     parser.add_argument("--mirror-only-one", type=str)
+    parser.add_argument(
+        "--jobs", type=int, default=int(os.environ.get("GEM_JOBS", "8"))
+    )
     args = parser.parse_args()
-    api = github.Github(ACCESS_TOKEN)
+    api = github.Github(ACCESS_TOKEN, per_page=100)
     log("--> get list of mirror repositories")
-    existing_repos = []
-    for repo in api.get_user("emacs-straight").get_repos():
-        existing_repos.append(repo.name)
+    # Only the names come from the listing. The repository objects are
+    # lazy, so nothing else is fetched unless a repository is edited.
+    existing_repos = {
+        name: api.get_repo(f"emacs-straight/{name}", lazy=True)
+        for name in get_repo_names(args.jobs)
+    }
+    mirrors = []
     if not args.skip_gnu_elpa:
-        mirror_gnu_elpa(args, api, existing_repos)
+        mirrors.append(mirror_gnu_elpa)
     if not args.skip_emacsmirror:
-        mirror_emacsmirror(args, api, existing_repos)
+        mirrors.append(mirror_emacsmirror)
     if not args.skip_orgmode:
-        mirror_orgmode(args, api, existing_repos)
+        mirrors.append(mirror_orgmode)
+    # PyGithub shares one connection between threads, so look up the
+    # organization here rather than in each mirror.
+    org = api.get_organization("emacs-straight")
+    # The three mirrors use separate directories and repositories, so
+    # there is no reason to wait for one before starting the next.
+    run_parallel(lambda fn: fn(args, org, existing_repos), mirrors, 3)
     if WEBHOOK_URL:
         log("--> update webhook")
-        resp = requests.get(WEBHOOK_URL)
+        resp = SESSION.get(WEBHOOK_URL)
         log(resp)
 
 